@@ -1,6 +0,0 @@
-import uuid
-
-def handler(event, context):
-    return {
-        'uuid': str(uuid.uuid4())
-    }
@@ -0,0 +1,34 @@
+import hashlib
+import json
+import os
+import boto3
+from botocore.config import Config
+
+# Keep connections alive between warm invocations and back off on throttling.
+# Three attempts at (2 + 5) seconds each fit within the 30 second function timeout.
+client_config = Config(
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    connect_timeout=2,
+    read_timeout=5
+)
+
+sfn_client = boto3.client('stepfunctions', config=client_config)
+
+def handler(event, context):
+    # Each SQS message body is an S3 "Object Created" event forwarded by EventBridge
+    items = [json.loads(record['body']) for record in event['Records']]
+
+    # Name the execution after the batch so a redelivered batch does not start it twice
+    message_ids = sorted(record['messageId'] for record in event['Records'])
+    execution_name = hashlib.sha256(''.join(message_ids).encode()).hexdigest()
+
+    try:
+        sfn_client.start_execution(
+            stateMachineArn=os.environ['STATE_MACHINE_ARN'],
+            name=execution_name,
+            input=json.dumps({'items': items})
+        )
+    except sfn_client.exceptions.ExecutionAlreadyExists:
+        # This batch was already started by an earlier delivery
+        pass
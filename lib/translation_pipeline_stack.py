@@ -2,13 +2,16 @@ from aws_cdk import (
     aws_s3 as s3,
     aws_iam as iam,
     aws_lambda as _lambda,
-    aws_s3_notifications as s3n,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_logs as logs,
+    aws_sqs as sqs,
     aws_stepfunctions as sfn,
     aws_stepfunctions_tasks as tasks,
     aws_events as events,
     aws_events_targets as targets,
+    Duration,
     RemovalPolicy,
-    App, Stack
+    Stack
 )
 from constructs import Construct
 
@@ -21,6 +24,7 @@ class TranslationPipelineStack(Stack):
         bucket = s3.Bucket(
             self, "TranslationBucket",
             removal_policy=RemovalPolicy.DESTROY,
+            event_bridge_enabled=True
         )
 
         # IAM role for Step Functions to interact with other AWS services
@@ -29,10 +33,6 @@ class TranslationPipelineStack(Stack):
             assumed_by=iam.ServicePrincipal("states.amazonaws.com")
         )
 
-        step_functions_role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaRole")
-        )
-
         step_functions_role.add_to_policy(
             iam.PolicyStatement(
                 resources=["*"],
@@ -42,121 +42,335 @@ class TranslationPipelineStack(Stack):
                     "transcribe:StartTranscriptionJob",
                     "transcribe:GetTranscriptionJob",
                     "translate:TranslateText",
-                    "polly:SynthesizeSpeech"
+                    "polly:StartSpeechSynthesisTask"
                 ]
             )
         )
 
-        # Lambda function to generate UUID
-        uuid_lambda = _lambda.Function(
-            self, "GenerateUUIDFunction",
-            runtime=_lambda.Runtime.PYTHON_3_8,
-            handler="generate_uuid.handler",
-            code=_lambda.Code.from_asset("lambda")
-        )
-
-        # Lambda function for filtering
-        filter_lambda = _lambda.Function(
-            self, "FilterFunction",
-            runtime=_lambda.Runtime.PYTHON_3_8,
-            handler="filter.handler",
-            code=_lambda.Code.from_asset("lambda")
-        )
-
-        # Lambda function for Polly synthesis
-        polly_lambda = _lambda.Function(
-            self, "SynthesizeSpeechFunction",
-            runtime=_lambda.Runtime.PYTHON_3_8,
-            handler="polly.handler",
-            code=_lambda.Code.from_asset("lambda")
+        # IAM role Transcribe uses for jobs queued beyond the concurrent job quota
+        transcribe_data_access_role = iam.Role(
+            self, "TranscribeDataAccessRole",
+            assumed_by=iam.ServicePrincipal("transcribe.amazonaws.com")
         )
+        bucket.grant_read_write(transcribe_data_access_role)
+        transcribe_data_access_role.grant_pass_role(step_functions_role)
 
         # Step Function Definition
-        uuid_task = tasks.LambdaInvoke(
-            self, "Generate UUID",
-            lambda_function=uuid_lambda,
-            output_path="$.Payload"
-        )
+        # Transcribe events are account-wide, so job names carry the stack name
+        # to keep each deployment from picking up another one's jobs
+        job_name_prefix = f"transcription.{self.stack_name}."
 
-        filter_task = tasks.LambdaInvoke(
-            self, "Filter",
-            lambda_function=filter_lambda,
-            result_path="$.filter_result"
+        # The EventBridge rule only matches keys under uploads/, so the
+        # bucket and key can be read straight from the event. The job id is
+        # generated with the States.UUID() intrinsic instead of a Lambda.
+        extract_task = sfn.Pass(
+            self, "Extract Object",
+            parameters={
+                "bucket.$": "$.detail.bucket.name",
+                "key.$": "$.detail.object.key",
+                "uuid.$": "States.UUID()"
+            }
         )
 
-        choice = sfn.Choice(self, "Should Process?")
-        is_process = sfn.Condition.boolean_equals("$.filter_result.should_process", True)
-
         transcribe_task = tasks.CallAwsService(
             self, "Transcribe",
             service="transcribe",
             action="startTranscriptionJob",
             parameters={
-                "TranscriptionJobName.$": "States.Format('transcription-{}', $.uuid)",
-                "LanguageCode": "auto",
+                "TranscriptionJobName.$": f"States.Format('{job_name_prefix}{{}}', $.uuid)",
+                "IdentifyLanguage": True,
                 "Media": {
-                    "MediaFileUri.$": "States.Format('s3://{}/{}', $.filter_result.bucket, $.filter_result.key)"
+                    "MediaFileUri.$": "States.Format('s3://{}/{}', $.bucket, $.key)"
                 },
                 "OutputBucketName": bucket.bucket_name,
-                "OutputKey.$": "States.Format('transcriptions/{}.json', $.uuid)"
+                "OutputKey.$": "States.Format('transcriptions/{}.json', $.uuid)",
+                # The Distributed Map starts far more jobs than Transcribe runs at
+                # once; queue the excess instead of having them rejected
+                "JobExecutionSettings": {
+                    "AllowDeferredExecution": True,
+                    "DataAccessRoleArn": transcribe_data_access_role.role_arn
+                }
             },
             iam_resources=["*"],
             result_path="$.transcription_result"
         )
+        transcribe_task.add_retry(
+            errors=["Transcribe.LimitExceededException"],
+            interval=Duration.seconds(2),
+            max_attempts=6,
+            backoff_rate=2.0,
+            jitter_strategy=sfn.JitterType.FULL
+        )
+
+        # Transcription jobs are named transcription.<stack name>.<uuid>, so the
+        # uuid can be recovered from the completion event
+        parse_job_task = sfn.Pass(
+            self, "Parse Job Name",
+            parameters={
+                "job_name.$": "$.detail.TranscriptionJobName",
+                "uuid.$": "States.ArrayGetItem(States.StringSplit($.detail.TranscriptionJobName, '.'), 2)"
+            }
+        )
 
         get_transcription_task = tasks.CallAwsService(
             self, "Get Transcription",
             service="transcribe",
             action="getTranscriptionJob",
             parameters={
-                "TranscriptionJobName.$": "$.transcription_result.TranscriptionJob.TranscriptionJobName"
+                "TranscriptionJobName.$": "$.job_name"
             },
             iam_resources=["*"],
             result_selector={
-                "transcript.$": "$.TranscriptionJob.Transcript.TranscriptFileUri"
+                "media.$": "$.TranscriptionJob.Media.MediaFileUri",
+                "transcript.$": "$.TranscriptionJob.Transcript.TranscriptFileUri",
+                "language_code.$": "$.TranscriptionJob.LanguageCode"
             },
             result_path="$.transcription_output"
         )
 
+        # Transcribe only returns the location of the transcript, so read the
+        # transcript JSON from the bucket. The whole object becomes the task
+        # result, which Step Functions caps at 256 KB, so check its size first
+        # and fail clearly instead of with States.DataLimitExceeded. Smaller
+        # transcripts can still exceed Translate's 10,000 byte text limit; that
+        # is caught on the Translate task and ends in the same Fail state.
+        head_transcript_task = tasks.CallAwsService(
+            self, "Check Transcript Size",
+            service="s3",
+            action="headObject",
+            iam_action="s3:GetObject",
+            parameters={
+                "Bucket": bucket.bucket_name,
+                "Key.$": "States.Format('transcriptions/{}.json', $.uuid)"
+            },
+            iam_resources=["*"],
+            result_selector={
+                "size.$": "$.ContentLength"
+            },
+            result_path="$.transcript_head"
+        )
+
+        transcript_too_large = sfn.Fail(
+            self, "Transcript Too Large",
+            error="TranscriptTooLarge",
+            cause="Transcript exceeds the Step Functions payload limit or Translate's 10,000 byte text limit"
+        )
+
+        fetch_transcript_task = tasks.CallAwsService(
+            self, "Fetch Transcript",
+            service="s3",
+            action="getObject",
+            parameters={
+                "Bucket": bucket.bucket_name,
+                "Key.$": "States.Format('transcriptions/{}.json', $.uuid)"
+            },
+            iam_resources=["*"],
+            result_selector={
+                "parsed.$": "States.StringToJson($.Body)"
+            },
+            result_path="$.transcript_body"
+        )
+
+        # Translate keys a few languages by region (e.g. zh-TW is Traditional
+        # Chinese, zh is Simplified); every other Transcribe code such as
+        # "es-US" has to be reduced to its base language "es"
+        is_region_variant = sfn.Condition.or_(*[
+            sfn.Condition.string_equals("$.transcription_output.language_code", code)
+            for code in ["fa-AF", "fr-CA", "es-MX", "pt-PT", "zh-TW"]
+        ])
+
+        keep_region = sfn.Pass(
+            self, "Keep Region Variant",
+            parameters={
+                "code.$": "$.transcription_output.language_code"
+            },
+            result_path="$.source_language"
+        )
+
+        strip_region = sfn.Pass(
+            self, "Strip Region",
+            parameters={
+                "code.$": "States.ArrayGetItem(States.StringSplit($.transcription_output.language_code, '-'), 0)"
+            },
+            result_path="$.source_language"
+        )
+
+        choose_source_language = sfn.Choice(self, "Region Variant?")
+        choose_source_language.when(is_region_variant, keep_region)
+        choose_source_language.otherwise(strip_region)
+
         translate_task = tasks.CallAwsService(
             self, "Translate",
             service="translate",
             action="translateText",
             parameters={
-                "Text.$": "States.JsonToString($.transcription_output.transcript)",
-                "SourceLanguageCode": "auto",
+                "Text.$": "$.transcript_body.parsed.results.transcripts[0].transcript",
+                "SourceLanguageCode.$": "$.source_language.code",
                 "TargetLanguageCode": "en"
             },
             iam_resources=["*"],
             result_path="$.translation_result"
         )
+        translate_task.add_retry(
+            errors=["Translate.TooManyRequestsException"],
+            interval=Duration.seconds(2),
+            max_attempts=6,
+            backoff_rate=2.0,
+            jitter_strategy=sfn.JitterType.FULL
+        )
+        translate_task.add_catch(
+            transcript_too_large,
+            errors=["Translate.TextSizeLimitExceededException"]
+        )
 
-        polly_task = tasks.LambdaInvoke(
+        # Polly writes the audio straight to the bucket, no Lambda in between
+        polly_task = tasks.CallAwsService(
             self, "Synthesize Speech",
-            lambda_function=polly_lambda,
-            payload=sfn.TaskInput.from_object({
-                "text": sfn.JsonPath.string_at("$.translation_result.TranslatedText"),
-                "bucket_name": bucket.bucket_name,
-                "key": sfn.JsonPath.string_at("States.Format('translations/{}.mp3', $.uuid)")
-            })
-        )
-
-        # Define the state machine
-        definition = (
-            filter_task.next(
-                choice.when(is_process, uuid_task.next(transcribe_task).next(get_transcription_task).next(translate_task).next(polly_task))
-                .otherwise(sfn.Pass(self, "Do Nothing"))
-            )
+            service="polly",
+            action="startSpeechSynthesisTask",
+            parameters={
+                "OutputFormat": "mp3",
+                "Text.$": "$.translation_result.TranslatedText",
+                "VoiceId": "Joanna",
+                "OutputS3BucketName": bucket.bucket_name,
+                "OutputS3KeyPrefix.$": "States.Format('translations/{}', $.uuid)"
+            },
+            iam_resources=["*"],
+            result_path="$.synthesis_result"
+        )
+
+        # Record the job metadata alongside the outputs
+        metadata_task = tasks.CallAwsService(
+            self, "Write Metadata",
+            service="s3",
+            action="putObject",
+            parameters={
+                "Bucket": bucket.bucket_name,
+                "Key.$": "States.Format('metadata/{}.json', $.uuid)",
+                "Body.$": "States.JsonToString($)",
+                "ContentType": "application/json"
+            },
+            iam_resources=["*"],
+            result_path=sfn.JsonPath.DISCARD
+        )
+
+        # Translation/speech and the metadata write are independent, so run them side by side
+        post_transcribe = sfn.Parallel(
+            self, "PostTranscribe",
+            result_path="$.results.parallel"
+        )
+        head_transcript_task.next(
+            sfn.Choice(self, "Transcript Fits?")
+            .when(sfn.Condition.number_greater_than("$.transcript_head.size", 200000), transcript_too_large)
+            .otherwise(fetch_transcript_task)
+        )
+        fetch_transcript_task.next(choose_source_language)
+        choose_source_language.afterwards().next(translate_task).next(polly_task)
+        post_transcribe.branch(head_transcript_task)
+        post_transcribe.branch(metadata_task)
+
+        # Each execution handles a batch of uploads; every file is started as
+        # its own short-lived Express child execution of the Distributed Map
+        per_file_map = sfn.DistributedMap(
+            self, "PerFile",
+            items_path="$.items",
+            max_concurrency=1000,
+            map_execution_type=sfn.StateMachineType.EXPRESS,
+            # A bad upload should only fail its own file, not the whole batch
+            tolerated_failure_percentage=100,
+            result_path=sfn.JsonPath.DISCARD
+        )
+        per_file_map.item_processor(extract_task.next(transcribe_task))
+
+        # Define the state machines. The first one ends once the transcription
+        # jobs are started; the second one is started by Transcribe's completion
+        # event, so nothing has to poll the job status.
+        definition = per_file_map
+
+        # The Express children of the Distributed Map keep no execution history
+        # and log through their parent's logging configuration
+        log_group = logs.LogGroup(
+            self, "TranslationLogGroup",
+            removal_policy=RemovalPolicy.DESTROY
         )
 
         state_machine = sfn.StateMachine(
             self, "TranslationStateMachine",
             definition_body=sfn.DefinitionBody.from_chainable(definition),
-            role=step_functions_role
+            role=step_functions_role,
+            logs=sfn.LogOptions(
+                destination=log_group,
+                level=sfn.LogLevel.ERROR
+            )
         )
-        
-        # EventBridge rule to trigger Step Function on S3 file upload
-        event_bus = events.EventBus(self, "MyEventBus")
+
+        # Failed jobs end here so they show up in the state machine's error log
+        transcription_failed = sfn.Fail(
+            self, "Transcription Failed",
+            error="TranscriptionFailed",
+            cause="Transcribe reported the transcription job as FAILED"
+        )
+
+        completion_definition = (
+            sfn.Choice(self, "Transcription Succeeded?")
+            .when(sfn.Condition.string_equals("$.detail.TranscriptionJobStatus", "FAILED"), transcription_failed)
+            .otherwise(parse_job_task.next(get_transcription_task).next(post_transcribe))
+        )
+
+        # Express workflows keep no execution history, so log failures instead
+        completion_log_group = logs.LogGroup(
+            self, "TranscriptionCompleteLogGroup",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        completion_state_machine = sfn.StateMachine(
+            self, "TranscriptionCompleteStateMachine",
+            definition_body=sfn.DefinitionBody.from_chainable(completion_definition),
+            role=step_functions_role,
+            state_machine_type=sfn.StateMachineType.EXPRESS,
+            logs=sfn.LogOptions(
+                destination=completion_log_group,
+                level=sfn.LogLevel.ERROR
+            )
+        )
+
+        # Uploads are queued and handed to the state machine in batches
+        upload_dead_letter_queue = sqs.Queue(self, "UploadDeadLetterQueue")
+        upload_queue = sqs.Queue(
+            self, "UploadQueue",
+            # AWS recommends six times the consuming function's timeout
+            visibility_timeout=Duration.seconds(180),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=upload_dead_letter_queue
+            )
+        )
+
+        # Lambda function to start one execution per batch of uploads
+        start_execution_lambda = _lambda.Function(
+            self, "StartExecutionFunction",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            architecture=_lambda.Architecture.ARM_64,
+            handler="index.handler",
+            code=_lambda.Code.from_asset("lambda/start_execution"),
+            memory_size=256,
+            timeout=Duration.seconds(30),
+            reserved_concurrent_executions=10,
+            environment={
+                "STATE_MACHINE_ARN": state_machine.state_machine_arn
+            }
+        )
+        state_machine.grant_start_execution(start_execution_lambda)
+        start_execution_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                upload_queue,
+                batch_size=100,
+                max_batching_window=Duration.seconds(30),
+                max_concurrency=10
+            )
+        )
+
+        # EventBridge rule to queue S3 file uploads
         rule = events.Rule(
             self, "Rule",
             event_pattern={
@@ -174,20 +388,20 @@ class TranslationPipelineStack(Stack):
                 }
             }
         )
-        # Add permission for EventBridge to invoke the filter Lambda function
-        filter_lambda.add_permission(
-            "AllowEventBridgeInvoke",
-            principal=iam.ServicePrincipal("events.amazonaws.com"),
-            source_arn=rule.rule_arn
-        )
-        rule.add_target(targets.SfnStateMachine(state_machine))
+        rule.add_target(targets.SqsQueue(upload_queue))
 
-        # S3 bucket notification to trigger the Step Function
-        bucket.add_event_notification(
-            s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(filter_lambda)
+        # EventBridge rule to continue the pipeline once a transcription job finishes
+        transcribe_rule = events.Rule(
+            self, "TranscriptionCompleteRule",
+            event_pattern={
+                "source": ["aws.transcribe"],
+                "detail_type": ["Transcribe Job State Change"],
+                "detail": {
+                    "TranscriptionJobStatus": ["COMPLETED", "FAILED"],
+                    "TranscriptionJobName": [{
+                        "prefix": job_name_prefix
+                    }]
+                }
+            }
         )
-
-app = App()
-TranslationPipelineStack(app, "TranslationPipelineStack")
-app.synth()
+        transcribe_rule.add_target(targets.SfnStateMachine(completion_state_machine))